@@ -2,9 +2,14 @@
 
 import argparse
 import datetime
-import urllib.request
-import json
-
+import hashlib
+import itertools
+import logging
+import os
+import shutil
+
+import ijson
+import requests
 import yaml
 import gantt
 import re
@@ -12,6 +17,40 @@ import re
 from dateutil.relativedelta import relativedelta
 from collections import OrderedDict
 
+logger = logging.getLogger(__name__)
+
+# Downloaded JSON files are kept here, so unchanged files aren't downloaded again
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'c3voc')
+
+# Plain numbers in the JSON feed refer to room cases
+_ROOM_DIGITS = frozenset("12345678")
+# These values are considered as non-assigned cases
+_UNASSIGNED_CASES = frozenset(["NEIN", "?", "X", "XX", "-"])
+
+
+def _classify_case(case):
+    """Work out whether a case from the JSON feed is a room case ('R'), an audio case ('A') or should be ignored (None)
+
+    Returns a tuple of the bucket and the normalised case name
+    """
+    case = case.replace('?', '')
+    if case == '@@CASE@@' or case == '':
+        return None, case
+
+    first_char = case[:1]
+    upper_case = case.upper()
+
+    if case in _ROOM_DIGITS:
+        return 'R', case
+    elif first_char == "A":
+        return 'A', upper_case
+    elif first_char == "S":
+        return 'R', upper_case
+    elif upper_case in _UNASSIGNED_CASES:
+        return None, upper_case
+    else:
+        return 'R', upper_case
+
 
 class ColourWheel:
     """Class that will return an endless aount of colors from a color wheel based on C3VOC green (#28C3AB)
@@ -24,37 +63,37 @@ class ColourWheel:
                '#DA8B00', '#DA5800']
 
     def __init__(self):
-        self.list_iterator = iter(self.colours)
+        self.list_iterator = itertools.cycle(self.colours)
 
     def __iter__(self):
-        return self
+        # Hand out the underlying cycle, so iterating doesn't go through __next__ for every colour
+        return self.list_iterator
 
     def __next__(self):
-        try:
-            colour = next(self.list_iterator)
-
-            return colour
-        except:
-            self.list_iterator = iter(self.colours)
-            colour = next(self.list_iterator)
-
-            return colour
+        return next(self.list_iterator)
 
 
 class C3VOCCalendar:
     """A class representing the C3VOC calendar. It parses various data sources and then exports them as a GANTT chart in SVG form"""
-    resources = {}
-    calendar = {}
 
     def __init__(self):
-        self.create_unique_gantt_resource('Unassigned')
+        self.resources = {}
+        self.calendar = {}
+        self._case_cache = {}
+
+        # A single session keeps the connection alive between requests
+        self._http = requests.Session()
+        self._http.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        self._get_or_create('Unassigned')
 
     def load_yaml_file(self, yaml_file_name):
         """Loads the requested YAML file and tries to parse it into a datastructure"""
         try:
             with open(yaml_file_name, 'r') as stream:
                 try:
-                    self.calendar = yaml.safe_load(stream)
+                    # Prefer the libyaml backed loader, fall back to the pure Python one
+                    self.calendar = yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
                     return True
                 except yaml.YAMLError as yaml_exception:
                     print(yaml_exception)
@@ -64,130 +103,152 @@ class C3VOCCalendar:
         return False
 
 
-    def is_event_were_interested_in(self, event_start_date, calendar_year):
-        if calendar_year:
-            return event_start_date.year == int(calendar_year)
+    def is_event_were_interested_in(self, event_start_date, year_prefix, cutoff):
+        """Check the ISO formatted (YYYY-MM-DD) start date as a string, so uninteresting events are dropped before
+        any date parsing is done
+        """
+        if year_prefix:
+            return event_start_date.startswith(year_prefix)
         else:
-            today = datetime.date.today()
-            first_of_the_year = today.replace(month=1)
-            first_of_the_year = first_of_the_year.replace(day=1)
+            return event_start_date >= cutoff
+
+    def _fetch_json_url(self, json_url):
+        """Download the URL into the local cache and return the path of the cached file.
+
+        The ETag of the last download is sent along, so an unchanged file is not transferred again
+        """
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        cache_name = os.path.join(CACHE_DIR, hashlib.sha256(json_url.encode()).hexdigest())
+        cache_file = cache_name + '.json'
+        etag_file = cache_name + '.etag'
+
+        headers = {}
+        if os.path.exists(cache_file) and os.path.exists(etag_file):
+            with open(etag_file, 'r') as etag:
+                headers['If-None-Match'] = etag.read().strip()
+
+        with self._http.get(json_url, headers=headers, timeout=30, stream=True) as response:
+            if response.status_code == 304:
+                return cache_file
+
+            response.raise_for_status()
+            # Let urllib3 undo any gzip/deflate encoding before the bytes hit the disk
+            response.raw.decode_content = True
+
+            with open(cache_file + '.tmp', 'wb') as cache:
+                shutil.copyfileobj(response.raw, cache)
+            os.replace(cache_file + '.tmp', cache_file)
 
-            return event_start_date >= first_of_the_year
+            if 'ETag' in response.headers:
+                with open(etag_file, 'w') as etag:
+                    etag.write(response.headers['ETag'])
+            elif os.path.exists(etag_file):
+                os.remove(etag_file)
+
+        return cache_file
 
     def load_json_url(self, json_url, calendar_year):
         """Downloads a json file from the supplied URL and reads into the format as defined by the YAML file loader"""
         try:
-            with urllib.request.urlopen(json_url) as url:
-                events = json.loads(url.read().decode())
-                #print(events)
-
-                for source_name, source_event in events["voc_events"].items():
-
-                    event_date = datetime.datetime.strptime(source_event["start_date"], "%Y-%m-%d").date()
-
-                    if self.is_event_were_interested_in(event_date, calendar_year):
-                        event = dict()
-                        event["start"] = event_date
-                        event["end"] = datetime.datetime.strptime(source_event["end_date"], "%Y-%m-%d").date()
-
-                        room_cases = []
-                        audio_cases = []
-
-                        #temp_cases = []
-                        #
-                        #for case in source_event["cases"]:
-                        #    if "/" in case:
-                        #        temp = case.split('/')
-                        #        for thing in temp:
-                        #            temp_cases.append(thing)
-                        #
-                        #    if "+" in case:
-                        #        temp = case.split('+')
-                        #        for thing in temp:
-                        #            temp_cases.append(thing)
-
-                        #for case in temp_cases:
-                        for case in source_event["cases"]:
-                            case = case.replace('?', '')
-                            if case == '@@CASE@@' or case == '':
-                                continue
-                            
-                            if case in ["1", "2", "3", "4", "5", "6", "7", "8"]:
-                                room_cases.append(case)
-                            elif case[0] == "A":
-                                audio_cases.append(case.upper())
-                            elif case[0] == "S":
-                                room_cases.append(case.upper())
-                            elif case.upper() in ["NEIN", "?", "X", "XX", "-"]:
-                                # These values are considered as non-assigned cases
-                                continue
-                            else:
-                                room_cases.append(case.upper())
-
-
-                        event["room cases"] = room_cases
-                        event["audio cases"] = audio_cases
-
-                        self.calendar[source_name] = event
+            with open(self._fetch_json_url(json_url), 'rb') as stream:
+                # These don't change between events, so only work them out once
+                year_prefix = "%04d-" % int(calendar_year) if calendar_year else None
+                cutoff = "%04d-01-01" % datetime.date.today().year
 
-                if len(self.calendar) > 0:
-                    #print("Calendar = %s" % str(self.calendar))
+                # Stream the events one by one instead of loading the whole document
+                for source_name, source_event in ijson.kvitems(stream, "voc_events"):
+                    self._process_event(source_name, source_event, year_prefix, cutoff)
+
+                logger.debug("Loaded %d events", len(self.calendar))
 
-                    print("Calendar = %s" % json.dumps(self.calendar, indent=2, cls=JSONEncoder))
+                if len(self.calendar) > 0:
                     return True
 
-        except Exception as e:
-            import traceback
-            print("""Received an exception: %s\nTraceback: %s""" % (str(e), traceback.format_exc()))
+        except (OSError, ijson.JSONError, ValueError) as load_error:
+            # Network and cache errors are OSErrors, broken JSON or dates end up here as well
+            logger.error("Loading events from %s failed: %s", json_url, load_error)
 
         return False
 
+    def _process_event(self, source_name, source_event, year_prefix, cutoff):
+        """Convert a single event from the JSON feed and add it to the calendar if we're interested in it"""
+        if not self.is_event_were_interested_in(source_event["start_date"], year_prefix, cutoff):
+            return
+
+        event = dict()
+        event["start"] = datetime.date.fromisoformat(source_event["start_date"])
+        event["end"] = datetime.date.fromisoformat(source_event["end_date"])
+
+        room_cases = []
+        audio_cases = []
+
+        #temp_cases = []
+        #
+        #for case in source_event["cases"]:
+        #    if "/" in case:
+        #        temp = case.split('/')
+        #        for thing in temp:
+        #            temp_cases.append(thing)
+        #
+        #    if "+" in case:
+        #        temp = case.split('+')
+        #        for thing in temp:
+        #            temp_cases.append(thing)
+
+        #for case in temp_cases:
+        for case in source_event["cases"]:
+            # The same cases show up in many events, so only classify each one once
+            entry = self._case_cache.get(case)
+            if entry is None:
+                entry = _classify_case(case)
+                self._case_cache[case] = entry
+
+            bucket, name = entry
+            if bucket == 'R':
+                room_cases.append(name)
+            elif bucket == 'A':
+                audio_cases.append(name)
+
+        event["room cases"] = room_cases
+        event["audio cases"] = audio_cases
+
+        self.calendar[source_name] = event
+
+
+    def _get_or_create(self, resource_name):
+        """Return the Gantt resource for the name, creating it on first use.
 
-    def is_resource_known(self, resource_name):
-        return resource_name in self.resources
-
-    def create_unique_gantt_resource(self, resource_name):
-        if not self.is_resource_known(resource_name):
+        This makes sure we only have 1 Gantt resource for all the occurences of a resource over all the events
+        """
+        resource = self.resources.get(resource_name)
+        if resource is None:
             resource = gantt.Resource(resource_name)
             self.resources[resource_name] = resource
             print('created resource', resource_name)
 
-    def create_resourses_from_event(self, event_details):
-        """Create a unique Gantt resource for all resources in the event.
-
-        This makes sure we only have 1 Gantt resource for all the occurences of a resource over all the events
-        """
-        if 'room cases' in event_details:
-            for room_case in event_details['room cases']:
-                self.create_unique_gantt_resource(room_case)
+        return resource
 
-        if 'audio cases' in event_details:
-            for audio_case in event_details['audio cases']:
-                self.create_unique_gantt_resource(audio_case)
+    def _collect_and_get_resources(self, event_details):
+        """Read the resources from the evernt details and return a list of the Gantt resources for the event.
 
-    def retrieve_resources_for_event(self, event_details):
-        """Read the resources from the evernt details and return a list of the Gantt resources for the event"""
+        Resources that haven't been seen before are created in the same pass
+        """
 
         necessary_resources = []
 
-        if 'room cases' in event_details:
-            for room_case in event_details['room cases']:
-                resource = self.resources[room_case]
-                necessary_resources.append(resource)
+        for room_case in event_details.get('room cases', ()):
+            necessary_resources.append(self._get_or_create(room_case))
 
-        if 'audio cases' in event_details:
-            for audio_case in event_details['audio cases']:
-                resource = self.resources[audio_case]
-                necessary_resources.append(resource)
+        for audio_case in event_details.get('audio cases', ()):
+            necessary_resources.append(self._get_or_create(audio_case))
 
         if len(necessary_resources) == 0:
-            resource = self.resources['Unassigned']
-            necessary_resources.append(resource)
+            necessary_resources.append(self.resources['Unassigned'])
 
         return necessary_resources
 
 
-    def create_event_as_gantt_task(self, event_name, event_details, colour):
+    def create_event_as_gantt_task(self, event_name, event_details, resources, colour):
         """Create a Gantt task  for the event and assign the resources"""
 
         # parse the start time into a datetime and find the length of the event in days
@@ -195,9 +256,6 @@ class C3VOCCalendar:
         end_date = event_details['end']
         duration = end_date - start_date
 
-        # Retrieve a list of the resources assigned to this event
-        resources = self.retrieve_resources_for_event(event_details)
-
         # Create the task
         task = gantt.Task(name = event_name,
                           start = start_date,
@@ -213,7 +271,7 @@ class C3VOCCalendar:
         the audio cases and room cases are resources
         """
 
-        colours = ColourWheel()
+        colours = iter(ColourWheel())
 
 
         # from https://blog.codinghorror.com/sorting-for-humans-natural-sort-order/
@@ -231,11 +289,11 @@ class C3VOCCalendar:
 
         for event_name, event_details in sorted_calendar.items():
             print(event_name, event_details)
-            # First gather the resources
-            self.create_resourses_from_event(event_details)
+            # Gather the resources, creating them as needed
+            resources = self._collect_and_get_resources(event_details)
 
             # Create the task and assign the resources
-            event = self.create_event_as_gantt_task(event_name = event_name, event_details = event_details, colour = next(colours))
+            event = self.create_event_as_gantt_task(event_name = event_name, event_details = event_details, resources = resources, colour = next(colours))
 
             # Add the task to the project
             self.gantt_project.add_task(event)
@@ -243,17 +301,10 @@ class C3VOCCalendar:
     def export_calendar_year(self, svg_name, year):
         """Create an SVG from Gantt project for the current year"""
         today = datetime.date.today()
-        start_date = today
-        start_date = start_date.replace(day = 1)
-        start_date = start_date.replace(month = 1)
+        calendar_year = int(year) if year else today.year
 
-        end_date = today
-        end_date = end_date.replace(month = 12)
-        end_date = end_date.replace(day = 31)
-
-        if year:
-            start_date = start_date.replace(year = int(year))
-            end_date = end_date.replace(year=int(year))
+        start_date = datetime.date(calendar_year, 1, 1)
+        end_date = datetime.date(calendar_year, 12, 31)
 
         self.gantt_project.make_svg_for_resources(
             filename = svg_name,
@@ -341,14 +392,6 @@ class C3VOCCalendar:
 
         return False
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime.date): 
-            return obj.__str__()
-        #if isinstance(obj, method-wrapper): 
-        #    return obj.__str__
-        return json.JSONEncoder.default(self, obj)
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", help="YAML file to use as source for the calendar", dest="calendar_yaml_file", action="store")